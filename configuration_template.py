@@ -26,6 +26,8 @@ class Config(object):
         self.seed = 42
         self.batch_size = 32
         self.num_workers = 8
+        self.prefetch_factor = 4
+        self.gpu_transforms = False  # normalize images on the device instead of in DataLoader workers
         self.checkpoint = f'./{self.prefix}_checkpoint.pth'
         self.project_data_path = './data'
         self.checkpoint_path = join(self.project_data_path, 'models', self.prefix)
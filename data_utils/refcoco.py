@@ -1,5 +1,6 @@
 from torch.utils.data import Dataset
-from torchvision.transforms import ColorJitter, ToTensor, Resize, ToTensor, Normalize, Compose
+import torch
+from torchvision.transforms import ColorJitter, ToTensor, Resize, ToTensor, Normalize, Compose, PILToTensor, ConvertImageDtype
 import torchvision as tv
 
 from PIL import Image
@@ -24,26 +25,37 @@ def get_transforms(mode, config):
         interpolation=default_transforms.interpolation
     )
 
+    if getattr(config, 'gpu_transforms', False):
+        # keep images as uint8 on the host and normalize batches on the device
+        # (the device transform is applied by the consumer after the transfer)
+        device_transform = Compose([
+            ConvertImageDtype(torch.float),
+            Normalize(mean=default_transforms.mean, 
+                      std=default_transforms.std),
+        ])
+        to_tensor = [PILToTensor()]
+    else:
+        device_transform = None
+        to_tensor = [
+            ToTensor(),
+            Normalize(mean=default_transforms.mean, 
+                      std=default_transforms.std),
+        ]
+
     if mode == 'train': 
         transform = Compose([
             ColorJitter(brightness=[0.5, 1.3],
                         contrast=[0.8, 1.5],
                         saturation=[0.2, 1.5]),
-            ToTensor(),
-            Normalize(mean=default_transforms.mean, 
-                      std=default_transforms.std),
+            *to_tensor,
         ])
         
     elif mode == 'val':
-        transform = Compose([
-            ToTensor(),
-            Normalize(mean=default_transforms.mean, 
-                      std=default_transforms.std),
-        ])
+        transform = Compose(to_tensor)
     else:
         raise NotImplementedError(f'transforms mode {mode} is not implemented')
     
-    return {'resize': resize, 'transform': transform}
+    return {'resize': resize, 'transform': transform, 'device_transform': device_transform}
 
 
 def auto_transform(mode, config):
@@ -74,6 +86,10 @@ class RefCocoCaption(Dataset):
         self.annot = [(entry['ann_id'], self._process(entry['image_id']),
                        entry['caption'], entry['bbox']) for entry in data]
 
+        # transformations for image batches after transfer to the model device
+        self.target_device_transform = self.target_transform.get('device_transform') if self.target_transform is not None else None
+        self.context_device_transform = self.context_transform.get('device_transform') if self.context_transform is not None else None
+
         # flags for input composition
         self.return_global_context = return_global_context
         self.return_location_features = return_location_features
@@ -9,10 +9,26 @@ from math import floor, ceil
 
 import json
 import os
+import sys
 
 MAX_DIM = 224
 
 
+def loader_settings(config):
+    """keyword arguments for DataLoaders shared by training and evaluation"""
+    settings = {
+        'num_workers': config.num_workers,
+        # page-locked host memory allows for asynchronous host-to-device copies
+        'pin_memory': torch.cuda.is_available(),
+    }
+    if config.num_workers > 0:
+        # keep workers alive across epochs and queue several batches per worker
+        # (persistent workers in combination with pinned memory crash on Windows)
+        settings['persistent_workers'] = sys.platform != 'win32'
+        settings['prefetch_factor'] = getattr(config, 'prefetch_factor', 4)
+    return settings
+
+
 def read_json(file_name):
     with open(file_name) as handle:
         out = json.load(handle)
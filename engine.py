@@ -9,7 +9,7 @@ from collections import defaultdict
 from os.path import dirname, abspath, join
 
 from models.utils import NestedTensor
-from eval_utils.decode import greedy_decoding
+from eval_utils.decode import greedy_decoding, CUDAGraphDecoder
 
 file_path = dirname(abspath(__file__))
 module_path = join(file_path, 'nlgeval')
@@ -20,30 +20,39 @@ from nlgeval import NLGEval
 def pack_encoder_inputs(encoder_input,
                         global_features,
                         location_features,
-                        device='cpu'):
+                        device='cpu',
+                        target_transform=None,
+                        context_transform=None):
+
+    def image_input(img, mask, transform):
+        samples = NestedTensor(img, mask).to(device, non_blocking=True)
+        if transform is not None:
+            # e.g. normalization of uint8 images on the device
+            samples.tensors = transform(samples.tensors)
+        return samples
 
     if not global_features and not location_features:
         # target only
         t_img, t_mask = encoder_input
         # return as tuple w/ len 1
-        return (NestedTensor(t_img, t_mask).to(device), )
+        return (image_input(t_img, t_mask, target_transform), )
     if global_features and not location_features:
         # target + global
         t_img, t_mask, g_img, g_mask = encoder_input
         # return as tuple w/ len 2
-        return (NestedTensor(t_img, t_mask).to(device),
-                NestedTensor(g_img, g_mask).to(device))
+        return (image_input(t_img, t_mask, target_transform),
+                image_input(g_img, g_mask, context_transform))
     elif not global_features and location_features:
         # target + location
         t_img, t_mask, l_feats = encoder_input
         # return as tuple w/ len 2
-        return (NestedTensor(t_img, t_mask).to(device), l_feats.to(device))
+        return (image_input(t_img, t_mask, target_transform), l_feats.to(device, non_blocking=True))
     elif global_features and location_features:
         # target + global + location
         t_img, t_mask, g_img, g_mask, l_feats = encoder_input
         # return as tuple w/ len 3
-        return (NestedTensor(t_img, t_mask).to(device),
-                NestedTensor(g_img, g_mask).to(device), l_feats.to(device))
+        return (image_input(t_img, t_mask, target_transform),
+                image_input(g_img, g_mask, context_transform), l_feats.to(device, non_blocking=True))
     else:
         raise NotImplementedError()
         
@@ -59,13 +68,16 @@ def train_one_epoch(model, criterion, data_loader,
 
     global_features = data_loader.dataset.return_global_context
     location_features = data_loader.dataset.return_location_features
+    target_transform = data_loader.dataset.target_device_transform
+    context_transform = data_loader.dataset.context_device_transform
 
     with tqdm.tqdm(total=total) as pbar:
         for ann_ids, *encoder_input, caps, cap_masks in data_loader:
             samples = pack_encoder_inputs(
-                encoder_input, global_features, location_features, device)
-            caps = caps.to(device)
-            cap_masks = cap_masks.to(device)
+                encoder_input, global_features, location_features, device,
+                target_transform, context_transform)
+            caps = caps.to(device, non_blocking=True)
+            cap_masks = cap_masks.to(device, non_blocking=True)
 
             outputs = model(*samples, caps[:, :-1], cap_masks[:, :-1])
             loss = criterion(outputs.permute(0, 2, 1), caps[:, 1:])
@@ -76,7 +88,7 @@ def train_one_epoch(model, criterion, data_loader,
                 print(f'Loss is {loss_value}, stopping training')
                 sys.exit(1)
 
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             if max_norm > 0:
                 torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm)
@@ -96,13 +108,16 @@ def evaluate(model, criterion, data_loader, device):
 
     global_features = data_loader.dataset.return_global_context
     location_features = data_loader.dataset.return_location_features
+    target_transform = data_loader.dataset.target_device_transform
+    context_transform = data_loader.dataset.context_device_transform
 
     with tqdm.tqdm(total=total) as pbar:
         for ann_ids, *encoder_input, caps, cap_masks in data_loader:
             samples = pack_encoder_inputs(
-                encoder_input, global_features, location_features, device)
-            caps = caps.to(device)
-            cap_masks = cap_masks.to(device)
+                encoder_input, global_features, location_features, device,
+                target_transform, context_transform)
+            caps = caps.to(device, non_blocking=True)
+            cap_masks = cap_masks.to(device, non_blocking=True)
 
             outputs = model(*samples, caps[:, :-1], cap_masks[:, :-1])
             loss = criterion(outputs.permute(0, 2, 1), caps[:, 1:])
@@ -122,12 +137,15 @@ def normalize_with_tokenizer(sent, tokenizer):
     return tokenizer.decode(tokenizer.encode(sent), skip_special_tokens=True)
 
 
+@torch.inference_mode()
+@torch.autocast(device_type='cuda', dtype=torch.bfloat16,
+                enabled=torch.cuda.is_available())
 def eval_model(model, data_loader, tokenizer,
                config, metrics_to_omit=[],
-               print_samples=False):
+               print_samples=False, use_cuda_graph=False):
     """
     iterate through val_loader and calculate CIDEr scores for model
-    (only works with batch_size=1 for now)
+    (expressions are decoded batch-wise)
     """
 
     model.eval()
@@ -149,18 +167,27 @@ def eval_model(model, data_loader, tokenizer,
 
     global_features = data_loader.dataset.return_global_context
     location_features = data_loader.dataset.return_location_features
+    target_transform = data_loader.dataset.target_device_transform
+    context_transform = data_loader.dataset.context_device_transform
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    # decoding graphs are captured once per batch size and replayed for all batches
+    cuda_graph_decoder = CUDAGraphDecoder(model) if use_cuda_graph and device == 'cuda' else None
 
     # decode imgs in val set
     for i, (ann_ids, *encoder_input, caps, cap_masks) in enumerate(tqdm.tqdm(data_loader)):
 
-        samples = pack_encoder_inputs(encoder_input, global_features, location_features)
+        samples = pack_encoder_inputs(
+            encoder_input, global_features, location_features, device,
+            target_transform, context_transform)
 
         # get model predictions
         hyps = greedy_decoding(
             samples, model, tokenizer,
             max_len=config.max_position_embeddings, clean=True,
             pad_token=pad_id, bos_token=bos_id, eos_token=eos_id,
-            device='auto'
+            device=device, cuda_graph_decoder=cuda_graph_decoder
         )
 
         hypotheses += hyps
@@ -2,12 +2,15 @@ import torch
 from torch.utils.data import DataLoader
 import argparse
 from models import caption
+from models.backbone import fuse_frozen_batchnorm
 from data_utils import refcoco
+from data_utils.utils import loader_settings
 from configuration import Config
 import os
 import json
 
 from eval_utils.decode import prepare_tokenizer
+from train_utils.checkpoints import read_ckp
 from engine import eval_model
 
 
@@ -23,9 +26,23 @@ def prepare_model(args, config):
     if not os.path.exists(args.checkpoint):
         raise NotImplementedError("Give valid checkpoint path")
     else:
-        model, _ = caption.build_model(config)
-        checkpoint = torch.load(args.checkpoint, map_location="cpu")
-        model.load_state_dict(checkpoint["model_state_dict"])
+        # build model and load checkpoint tensors directly on the target device
+        with torch.device(args.device):
+            model, _ = caption.build_model(config, pretrained_backbone=False)
+        checkpoint = read_ckp(args.checkpoint, map_location=args.device)
+        # use checkpoint tensors directly instead of copying them into the initialized ones
+        model.load_state_dict(checkpoint["model_state_dict"], assign=True)
+        model.eval()
+        # the backbone is frozen for inference: fold norm layers into convolutions
+        model.backbone.requires_grad_(False)
+        fuse_frozen_batchnorm(model.backbone)
+        model = model.to_channels_last()
+
+        if args.device == "cuda" and not args.use_cuda_graph_decoder:
+            # fuse the per-token decoding path (default mode: the key/value cache is
+            # updated in place, which rules out cudagraph replay in reduce-overhead mode;
+            # graph replay is available via --use_cuda_graph_decoder)
+            model.decode_step = torch.compile(model.decode_step, fullgraph=False)
 
     return model
 
@@ -41,7 +58,7 @@ def setup_val_dataloader(config, split='validation'):
         batch_size=config.batch_size,
         sampler=sampler_val,
         drop_last=False,
-        num_workers=config.num_workers,
+        **loader_settings(config),
     )
     return data_loader_val
 
@@ -85,7 +102,7 @@ def override_config_with_checkpoint(checkpoint, config):
 def main_val_set(args, config):
 
     # model
-    model = prepare_model(args, config).to(args.device)
+    model = prepare_model(args, config)
     print(f'Successfully loaded {model.__class__.__name__} model')
 
     # tokenizer
@@ -94,7 +111,8 @@ def main_val_set(args, config):
     data_loader = setup_val_dataloader(config, args.split)
 
     metrics, generated = eval_model(
-        model, data_loader, tokenizer, config, print_samples=args.print_samples
+        model, data_loader, tokenizer, config, print_samples=args.print_samples,
+        use_cuda_graph=args.use_cuda_graph_decoder
     )
 
     return metrics, generated
@@ -114,6 +132,7 @@ if __name__ == "__main__":
     parser.add_argument("--print_samples", action="store_true")
     parser.add_argument("--store_results", action="store_true")
     parser.add_argument("--override_config", action="store_true")
+    parser.add_argument("--use_cuda_graph_decoder", action="store_true")
     args = parser.parse_args()
 
     if args.device == "auto":
@@ -36,8 +36,11 @@ def greedy_single(model, image, tokenizer, start_token, end_token, max_pos_embed
     with torch.no_grad():
         model.eval()
 
+        # visual inputs are encoded once and reused for every decoding step
+        encoded = model.encode(image)
+
         for i in range(max_pos_embeddings - 1):
-            predictions = model(image, caption, cap_mask)
+            predictions = model.decode(*encoded, caption, cap_mask)
             predictions = predictions[:, i, :]
             predicted_id = torch.argmax(predictions, axis=-1)
 
@@ -50,33 +53,129 @@ def greedy_single(model, image, tokenizer, start_token, end_token, max_pos_embed
     return tokenizer.decode(caption[0], skip_special_tokens=True)
 
 
-def greedy(samples, model, max_len=20, device="auto", bos_token=1, eos_token=2):
-    """greedy decoding for a batch of samples"""
+def capture_decoder(decode_step, warmup_steps=3):
+    """
+    capture a single decoding step as CUDA graph
+    (inputs of decode_step serve as static inputs and have to be updated in place)
+    """
+
+    # warmup on a side stream before capturing
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warmup_steps):
+            decode_step()
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_predictions = decode_step()
+
+    return graph, static_predictions
+
+
+class CUDAGraphDecoder:
+    """
+    decoding step captured as CUDA graph and reused across batches
+    (one graph per input shape; static inputs are refilled in place for every batch)
+    """
+
+    def __init__(self, model, warmup_steps=3):
+        self.model = model
+        self.warmup_steps = warmup_steps
+        self.graphs = {}
+
+    def _capture(self, memory, mask, pos_embed, cache):
+        static_state = (
+            memory.clone(), mask.clone(), pos_embed.clone(),
+            [(k.clone(), v.clone()) for k, v in cache]
+        )
+        token = torch.zeros((memory.size(1), 1), dtype=torch.long, device=memory.device)
+        step = torch.zeros((), dtype=torch.long, device=memory.device)
+
+        graph, static_predictions = capture_decoder(
+            lambda: self.model.decode_step(*static_state, token, step),
+            warmup_steps=self.warmup_steps
+        )
+        return static_state, token, step, graph, static_predictions
+
+    def prepare(self, decoding_state):
+        """
+        copy the outputs of model.init_decoding() into the static inputs
+        (captured on first use of their shapes); returns static token / step inputs
+        and a function replaying the graph
+        """
+        memory, mask, pos_embed, cache = decoding_state
+
+        key = (memory.shape, mask.shape, pos_embed.shape)
+        if key not in self.graphs:
+            self.graphs[key] = self._capture(memory, mask, pos_embed, cache)
+        static_state, token, step, graph, static_predictions = self.graphs[key]
+
+        static_memory, static_mask, static_pos_embed, static_cache = static_state
+        static_memory.copy_(memory)
+        static_mask.copy_(mask)
+        static_pos_embed.copy_(pos_embed)
+        for cache_k, cache_v in static_cache:
+            cache_k.zero_()
+            cache_v.zero_()
+
+        def replay():
+            graph.replay()
+            return static_predictions
+
+        return token, step, replay
+
+
+@torch.inference_mode()
+def greedy(samples, model, max_len=20, device="auto", pad_token=0, bos_token=1, eos_token=2, cuda_graph_decoder=None, sync_interval=8):
+    """
+    greedy decoding for a batch of samples
+    (predictions stay on the device; checking whether all sequences are finished
+    requires a device sync and is only done every `sync_interval` steps;
+    decoding steps are replayed from `cuda_graph_decoder` if given)
+    """
 
     if device == "auto":
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    caption, cap_mask = create_caption_and_mask(
+    caption, _ = create_caption_and_mask(
         bos_token, max_len, samples[0].shape[0])
 
-    samples = [s.to(device) for s in samples]
+    samples = [s.to(device, non_blocking=True) for s in samples]
     caption = caption.to(device)
-    cap_mask = cap_mask.to(device)
 
     finished = torch.zeros(caption.shape[0], dtype=bool, device=device)
 
+    # visual inputs and transformer encoder are run once,
+    # decoder self-attention keys/values of previous positions are cached
+    decoding_state = model.init_decoding(*model.encode(*samples))
+
+    # static inputs for each step: last token and its position
+    if cuda_graph_decoder is not None:
+        token, step, decode_step = cuda_graph_decoder.prepare(decoding_state)
+        token.copy_(caption[:, :1])
+    else:
+        token = caption[:, :1].clone()
+        step = torch.zeros((), dtype=torch.long, device=device)
+
+        def decode_step():
+            return model.decode_step(*decoding_state, token, step)
+
     for i in range(max_len - 1):
-        predictions = model(*samples, caption, cap_mask)
-        predictions = predictions[:, i, :]
+        step.fill_(i)
+        predictions = decode_step()[:, 0, :]
         predicted_id = torch.argmax(predictions, axis=-1)
+        # sequences which already ended are filled up with padding
+        predicted_id = predicted_id.masked_fill(finished, pad_token)
+
+        caption[:, i + 1] = predicted_id
+        token.copy_(predicted_id.unsqueeze(1))
 
         is_eos = predicted_id == eos_token
         finished = torch.logical_or(is_eos, finished)
-        if all(finished):
-            return caption
-
-        caption[:, i + 1] = predicted_id
-        cap_mask[:, i + 1] = False
+        if (i + 1) % sync_interval == 0 and finished.all():
+            break
 
     return caption
 
@@ -109,13 +208,13 @@ def idx2sents(idx_seqs, tokenizer, skip_special_tokens=True):
     )
 
 
-def greedy_decoding(samples, model, tokenizer, max_len=20, clean=True, pad_token=0, bos_token=1, eos_token=2, device='auto'):
+def greedy_decoding(samples, model, tokenizer, max_len=20, clean=True, pad_token=0, bos_token=1, eos_token=2, device='auto', cuda_graph_decoder=None):
     """wrapper for greedy decoding"""
 
     if device == 'auto':
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    caption_idx = greedy(samples, model, max_len=max_len, bos_token=bos_token, eos_token=eos_token, device=device)
+    caption_idx = greedy(samples, model, max_len=max_len, pad_token=pad_token, bos_token=bos_token, eos_token=eos_token, device=device, cuda_graph_decoder=cuda_graph_decoder)
     caption_idx = caption_idx.cpu().detach().numpy().tolist()
 
     pruned_caption_idx = prune_cap_ids(
@@ -146,8 +245,11 @@ def greedy_with_att(model, sample, tokenizer, start_token=1, end_token=2, max_po
     with torch.no_grad():
         model.eval()
 
+        # visual inputs are encoded once and reused for every decoding step
+        encoded = model.encode(*sample)
+
         for i in range(max_pos_embeddings - 1):
-            predictions, att = model(*sample, caption, cap_mask, return_attention=True)
+            predictions, att = model.decode(*encoded, caption, cap_mask, return_attention=True)
             predictions = predictions[:, i, :]
             predicted_id = torch.argmax(predictions, axis=-1)
                         
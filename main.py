@@ -3,14 +3,26 @@ from torch.utils.data import DataLoader
 
 import numpy as np
 import os
+import sys
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 from models import utils, caption
 from data_utils import refcoco
+from data_utils.utils import loader_settings
 from configuration import Config
 from engine import train_one_epoch, evaluate, eval_model
-from train_utils.checkpoints import save_ckp
+from train_utils.checkpoints import save_ckp_async
 from eval_utils.decode import prepare_tokenizer
 
+log = logging.getLogger('train')
+log.setLevel(logging.INFO)
+if not log.handlers:
+    log.addHandler(logging.StreamHandler(sys.stdout))
+    # avoid duplicate records if the root logger is configured elsewhere
+    log.propagate = False
+
 
 def main(config):
     device = torch.device(config.device)
@@ -27,16 +39,28 @@ def main(config):
                        for p in model.parameters() if p.requires_grad)
     print(f"Number of params: {n_parameters}")
 
+    # split trainable parameters into backbone and remaining model in a single pass
+    head_params, backbone_params = [], []
+    for n, p in model.named_parameters():
+        if not p.requires_grad:
+            continue
+        (backbone_params if "backbone" in n else head_params).append(p)
     param_dicts = [
-        {"params": [p for n, p in model.named_parameters(
-        ) if "backbone" not in n and p.requires_grad]},
+        {"params": head_params},
         {
-            "params": [p for n, p in model.named_parameters() if "backbone" in n and p.requires_grad],
+            "params": backbone_params,
             "lr": config.lr_backbone,
         },
     ]
-    optimizer = torch.optim.AdamW(
-        param_dicts, lr=config.lr, weight_decay=config.weight_decay)
+    try:
+        # fused kernel: single launch for the update of all parameters
+        optimizer = torch.optim.AdamW(
+            param_dicts, lr=config.lr, weight_decay=config.weight_decay,
+            fused=device.type == 'cuda')
+    except RuntimeError:
+        # fused implementation does not support the parameters' device / dtype
+        optimizer = torch.optim.AdamW(
+            param_dicts, lr=config.lr, weight_decay=config.weight_decay, foreach=True)
     lr_scheduler = torch.optim.lr_scheduler.StepLR(optimizer, config.lr_drop)
     tokenizer, _, _ = prepare_tokenizer()
 
@@ -57,11 +81,11 @@ def main(config):
     )
 
     data_loader_train = DataLoader(
-        dataset_train, batch_sampler=batch_sampler_train, num_workers=config.num_workers)
+        dataset_train, batch_sampler=batch_sampler_train, **loader_settings(config))
     data_loader_val = DataLoader(dataset_val, config.batch_size,
-                                 sampler=sampler_val, drop_last=False, num_workers=config.num_workers)
+                                 sampler=sampler_val, drop_last=False, **loader_settings(config))
     data_loader_cider = DataLoader(dataset_cider, config.batch_size,
-                                 sampler=sampler_cider, drop_last=False, num_workers=config.num_workers)
+                                 sampler=sampler_cider, drop_last=False, **loader_settings(config))
 
     if not os.path.exists(config.checkpoint_path):
         os.mkdir(config.checkpoint_path)
@@ -69,38 +93,48 @@ def main(config):
     loc_used = '_loc' if config.use_location_features else ''
     glob_used = '_glob' if config.use_global_features else ''
     cpt_template = f'{config.transformer_type}_{config.prefix}{loc_used}{glob_used}_checkpoint_#.pth'
+    checkpoint_dir = os.path.abspath(config.checkpoint_path)
+
+    # checkpoints are written by a background thread while training continues
+    ckp_executor = ThreadPoolExecutor(max_workers=1)
+    pending_ckp = None
 
     print("Start Training..")
-    cider_scores = [0]
+    # scores of the last 5 epochs for early stopping
+    cider_scores = deque([0], maxlen=5)
     for epoch in range(config.start_epoch, config.epochs):
-        print(f"Epoch: {epoch}")
         epoch_loss = train_one_epoch(
             model, criterion, data_loader_train, optimizer, device, epoch, config.clip_max_norm)
         lr_scheduler.step()
-        print(f"Training Loss: {epoch_loss}")
 
         validation_loss = evaluate(model, criterion, data_loader_val, device)
-        print(f"Validation Loss: {validation_loss}")
 
         eval_results, _ = eval_model(model, data_loader_cider, tokenizer, config)
         cider_score = eval_results['CIDEr']
-        print(f"CIDEr score: {cider_score}")
+
+        # one log record per epoch
+        log.info('epoch=%d training_loss=%.4f validation_loss=%.4f cider=%.4f',
+                 epoch, epoch_loss, validation_loss, cider_score)
 
         checkpoint_name = cpt_template.replace('#', str(epoch))
-        save_ckp(
-            epoch, model, optimizer, lr_scheduler, 
+        if pending_ckp is not None:
+            pending_ckp.result()
+        pending_ckp = save_ckp_async(
+            ckp_executor, epoch, model, optimizer, lr_scheduler, 
             train_loss=epoch_loss, val_loss=validation_loss, cider_score=cider_score,
-            path=os.path.join(config.checkpoint_path, checkpoint_name)
+            path=os.path.join(checkpoint_dir, checkpoint_name)
         )
         
         if config.early_stopping:
-            if cider_score < min(cider_scores[-5:]):
-                print('no improvements within the last 5 epochs -- early stopping triggered!')
+            if cider_score < min(cider_scores):
+                log.info('no improvements within the last 5 epochs -- early stopping triggered!')
                 break
 
         cider_scores.append(cider_score)
 
-        print()
+    if pending_ckp is not None:
+        pending_ckp.result()
+    ckp_executor.shutdown()
 
 
 if __name__ == "__main__":
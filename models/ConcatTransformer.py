@@ -37,12 +37,17 @@ class ConcatTransformer(nn.Module):
         self.d_model = d_model
         self.nhead = nhead
 
+        # causal mask for incremental decoding (True: position is not attended to)
+        max_len = config.max_position_embeddings
+        self.register_buffer(
+            'causal_mask', torch.ones(max_len, max_len, dtype=torch.bool).triu(1), persistent=False)
+
     def _reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def forward(self, src_t, mask_t, src_c, mask_c, tgt, tgt_mask):
+    def _encode(self, src_t, mask_t, src_c, mask_c):
 
         # merge information
         if src_c is not None:
@@ -55,24 +60,76 @@ class ConcatTransformer(nn.Module):
         pos_embed = self.positional_encoding(src)
 
         # permute NxCxHW to HWxNxC
-        bs, c, hw = src.shape
-
         src = src.permute(2, 0, 1)
         pos_embed = pos_embed.permute(2, 0, 1)
 
+        memory, encoder_atts = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)
+
+        return memory, mask, pos_embed, encoder_atts
+
+    def forward(self, src_t, mask_t, src_c, mask_c, tgt, tgt_mask):
+
+        memory, mask, pos_embed, encoder_atts = self._encode(src_t, mask_t, src_c, mask_c)
+        bs = memory.size(1)
+
         tgt = self.embeddings(tgt).permute(1, 0, 2)
         query_embed = self.embeddings.position_embeddings.weight.unsqueeze(1)
         query_embed = query_embed.repeat(1, bs, 1)
 
-        memory, encoder_atts = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)
         out, decoder_atts = self.decoder(tgt, memory, memory_key_padding_mask=mask, tgt_key_padding_mask=tgt_mask,
                           pos=pos_embed, query_pos=query_embed,
-                          tgt_mask=generate_square_subsequent_mask(len(tgt)).to(tgt.device))
+                          tgt_mask=generate_square_subsequent_mask(len(tgt), device=tgt.device))
 
         atts = {**encoder_atts, **decoder_atts}
 
         return out, atts
 
+    def encode(self, src_t, mask_t, src_c, mask_c):
+        """run the encoder once for incremental decoding, returns (memory, mask, pos_embed)"""
+        memory, mask, pos_embed, _ = self._encode(src_t, mask_t, src_c, mask_c)
+        return memory, mask, pos_embed
+
+    def init_cache(self, memory):
+        """
+        allocate self-attention key/value caches for all decoder layers
+        (projected per-head keys/values, static shape [b, nhead, max_len, head_dim],
+        filled position by position)
+        """
+        max_len, bs = self.causal_mask.size(0), memory.size(1)
+        shape = (bs, self.nhead, max_len, self.d_model // self.nhead)
+        # keys/values are stored in the dtype they are computed in
+        # (memory may be fp32 under autocast, e.g. after the final encoder norm)
+        device_type = memory.device.type
+        if torch.is_autocast_enabled(device_type):
+            dtype = torch.get_autocast_dtype(device_type)
+        else:
+            dtype = memory.dtype
+        return [
+            (memory.new_zeros(shape, dtype=dtype), memory.new_zeros(shape, dtype=dtype))
+            for _ in self.decoder.layers
+        ]
+
+    def decode_step(self, tgt, step, memory, mask, pos_embed, cache):
+        """
+        decode a single position using cached self-attention keys/values
+
+        Args:
+            tgt: token ids at position `step` [b, 1]
+            step: position index (0-dim long tensor, keeps shapes static across steps)
+            memory, mask, pos_embed: outputs of encode()
+            cache: output of init_cache(), updated in place
+        """
+        bs = tgt.size(0)
+        step = step.view(1)
+
+        tgt = self.embeddings(tgt, position_ids=step.expand(bs, 1)).permute(1, 0, 2)  # [1, b, d_model]
+        query_pos = self.embeddings.position_embeddings(step).unsqueeze(1)  # [1, 1, d_model]
+
+        return self.decoder.forward_step(
+            tgt, memory, cache, step,
+            self_attn_mask=self.causal_mask.index_select(0, step),
+            memory_key_padding_mask=mask, pos=pos_embed, query_pos=query_pos)
+
 
 class TransformerEncoder(nn.Module):
 
@@ -148,6 +205,25 @@ class TransformerDecoder(nn.Module):
 
         return output, stacked_atts
 
+    def forward_step(self, tgt, memory, cache, step,
+                     self_attn_mask: Optional[Tensor] = None,
+                     memory_key_padding_mask: Optional[Tensor] = None,
+                     pos: Optional[Tensor] = None,
+                     query_pos: Optional[Tensor] = None):
+
+        output = tgt
+
+        for layer, (cache_k, cache_v) in zip(self.layers, cache):
+            output = layer.forward_step(output, memory, cache_k, cache_v, step,
+                                        self_attn_mask=self_attn_mask,
+                                        memory_key_padding_mask=memory_key_padding_mask,
+                                        pos=pos, query_pos=query_pos)
+
+        if self.norm is not None:
+            output = self.norm(output)
+
+        return output
+
 
 class TransformerEncoderLayer(nn.Module):
 
@@ -256,6 +332,39 @@ class TransformerDecoderLayer(nn.Module):
 
         return tgt, att_values
 
+    def forward_step(self, tgt, memory, cache_k, cache_v, step,
+                     self_attn_mask: Optional[Tensor] = None,
+                     memory_key_padding_mask: Optional[Tensor] = None,
+                     pos: Optional[Tensor] = None,
+                     query_pos: Optional[Tensor] = None):
+
+        # EXPRESSION SELF ATT (over cached positions)
+        tgt = self.tgt_self_attn.forward_step(
+            qkv=tgt,
+            qkv_pos=query_pos,
+            cache_k=cache_k,
+            cache_v=cache_v,
+            step=step,
+            attn_mask=self_attn_mask
+        )
+
+        # EXPRESSION / TARGET CROSS ATT
+        tgt, _ = self.tgt_src_cross_attn(
+            q=tgt,
+            kv=memory,
+            q_pos=query_pos,
+            k_pos=pos,
+            attn_mask=None,
+            key_padding_mask=memory_key_padding_mask
+        )
+
+        # FEED FORWARD
+        tgt = self.ff(
+            tgt
+        )
+
+        return tgt
+
 def build_transformer(config):
     return ConcatTransformer(
         config,
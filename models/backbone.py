@@ -51,6 +51,32 @@ class FrozenBatchNorm2d(torch.nn.Module):
         return x * scale + bias
 
 
+@torch.no_grad()
+def fuse_frozen_batchnorm(module: nn.Module):
+    """
+    fold FrozenBatchNorm2d layers into the preceding convolutions (for inference only)
+    torchvision ResNets register every norm layer directly after its convolution
+    """
+    for child in module.children():
+        fuse_frozen_batchnorm(child)
+
+    names = list(module._modules.keys())
+    for conv_name, bn_name in zip(names, names[1:]):
+        conv, bn = module._modules[conv_name], module._modules[bn_name]
+        if not isinstance(conv, nn.Conv2d) or not isinstance(bn, FrozenBatchNorm2d):
+            continue
+        # same computation as in FrozenBatchNorm2d.forward
+        scale = bn.weight * (bn.running_var + 1e-5).rsqrt()
+        bias = bn.bias - bn.running_mean * scale
+        if conv.bias is not None:
+            bias = bias + conv.bias * scale
+        conv.weight = nn.Parameter(conv.weight * scale.reshape(-1, 1, 1, 1), requires_grad=False)
+        conv.bias = nn.Parameter(bias, requires_grad=False)
+        setattr(module, bn_name, nn.Identity())
+
+    return module
+
+
 class BackboneBase(nn.Module):
 
     def __init__(self, backbone: nn.Module, train_backbone: bool, num_channels: int, return_interm_layers: bool):
@@ -82,9 +108,10 @@ class Backbone(BackboneBase):
     def __init__(self, name: str,
                  train_backbone: bool,
                  return_interm_layers: bool,
-                 dilation: bool):
+                 dilation: bool,
+                 pretrained: bool = True):
         backbone_model = getattr(torchvision.models, name.lower())
-        backbone_pretrained = is_main_process()
+        backbone_pretrained = pretrained and is_main_process()
         backbone_weights = getattr(torchvision.models, name + '_Weights').DEFAULT if backbone_pretrained else None
         backbone = backbone_model(
             replace_stride_with_dilation=[False, False, dilation],
@@ -111,8 +138,8 @@ class Joiner(nn.Sequential):
         return out, pos  
 
 
-def build_backbone(config):
+def build_backbone(config, pretrained=True):
     train_backbone = config.lr_backbone > 0
     return_interm_layers = False
-    backbone = Backbone(config.backbone, train_backbone, return_interm_layers, config.dilation)
+    backbone = Backbone(config.backbone, train_backbone, return_interm_layers, config.dilation, pretrained)
     return backbone
\ No newline at end of file
@@ -2,12 +2,57 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 
-from .utils import NestedTensor, nested_tensor_from_tensor_list, ensure_unmasked_values
+from .utils import as_nested_tensor, ensure_unmasked_values
 from .backbone import build_backbone
 from .ConcatTransformer import build_transformer as build_concat_transformer
 
 
-class Caption(nn.Module):
+class _CaptionBase(nn.Module):
+    """
+    shared image encoding and incremental decoding for the Caption* models
+    (requires backbone, input_proj, transformer and mlp)
+    """
+
+    # memory format of backbone inputs (matches the weights, see to_channels_last())
+    input_memory_format = torch.contiguous_format
+
+    def to_channels_last(self):
+        """convert weights and backbone inputs to NHWC layout (faster cuDNN kernels for inference)"""
+        self.input_memory_format = torch.channels_last
+        return self.to(memory_format=torch.channels_last)
+
+    def _encode(self, samples, ensure_unmasked=False):
+        samples = as_nested_tensor(samples)
+        samples.tensors = samples.tensors.contiguous(memory_format=self.input_memory_format)
+        features = self.backbone(samples)['0']
+        src, mask = features.decompose()
+        src = self.input_proj(src)
+        assert mask is not None
+        if ensure_unmasked:
+            # ensure there are unmasked values
+            mask = ensure_unmasked_values(mask)
+        # flatten vectors
+        src = src.flatten(2)  # [b, hidden_dim, len]
+        mask = mask.flatten(1)  # [b, len]
+
+        return src, mask
+
+    def init_decoding(self, src_t, mask_t, src_c, mask_c):
+        """
+        run the transformer encoder once on the outputs of encode()
+        and allocate the decoder cache for decode_step()
+        """
+        memory, mask, pos_embed = self.transformer.encode(src_t, mask_t, src_c, mask_c)
+        cache = self.transformer.init_cache(memory)
+        return memory, mask, pos_embed, cache
+
+    def decode_step(self, memory, mask, pos_embed, cache, target_exp, step):
+        """predict the token following target_exp [b, 1] at position step"""
+        hs = self.transformer.decode_step(target_exp, step, memory, mask, pos_embed, cache)
+        return self.mlp(hs.permute(1, 0, 2))  # [b, 1, vocab_size]
+
+
+class Caption(_CaptionBase):
 
     def __init__(self, backbone, transformer, positional_encoding, hidden_dim,
                  vocab_size):
@@ -18,26 +63,24 @@ class Caption(nn.Module):
                                     out_channels=hidden_dim,
                                     kernel_size=1)
         self.transformer = transformer
-        self.mlp = MLP(hidden_dim, 512, vocab_size, 3)
+        self.mlp = MLP(hidden_dim, 512, vocab_size)
 
     def forward(self, samples, target_exp, target_exp_mask, return_attention=False):
+        return self.decode(*self.encode(samples), target_exp, target_exp_mask,
+                           return_attention=return_attention)
+
+    def encode(self, samples):
 
         # target features
+        src, mask = self._encode(samples)
 
-        if not isinstance(samples, NestedTensor):
-            samples = nested_tensor_from_tensor_list(samples)
+        return src, mask, None, None
 
-        features = self.backbone(samples)['0']
-        src, mask = features.decompose()
-        src = self.input_proj(src)
-        assert mask is not None
-        # flatten vectors
-        src = src.flatten(2)
-        mask = mask.flatten(1)
+    def decode(self, src_t, mask_t, src_c, mask_c, target_exp, target_exp_mask, return_attention=False):
 
         hs, att = self.transformer(
-            src_t=src, mask_t=mask, 
-            src_c=None, mask_c=None, 
+            src_t=src_t, mask_t=mask_t, 
+            src_c=src_c, mask_c=mask_c, 
             tgt=target_exp, tgt_mask=target_exp_mask)
         out = self.mlp(hs.permute(1, 0, 2))
 
@@ -47,7 +90,7 @@ class Caption(nn.Module):
         return out
     
 
-class CaptionLoc(nn.Module):
+class CaptionLoc(_CaptionBase):
 
     def __init__(self, backbone, transformer, positional_encoding, hidden_dim,
                  vocab_size):
@@ -59,33 +102,33 @@ class CaptionLoc(nn.Module):
                                     kernel_size=1)
         self.loc_proj = nn.Linear(7, hidden_dim)
         self.transformer = transformer
-        self.mlp = MLP(hidden_dim, 512, vocab_size, 3)
+        self.mlp = MLP(hidden_dim, 512, vocab_size)
+        # location features are never masked out
+        self.register_buffer('loc_mask_const', torch.zeros(1, 1, dtype=torch.bool), persistent=False)
 
     def forward(self, t_samples, loc_feats, target_exp, target_exp_mask, return_attention=False):
+        return self.decode(*self.encode(t_samples, loc_feats), target_exp, target_exp_mask,
+                           return_attention=return_attention)
+
+    def encode(self, t_samples, loc_feats):
 
         # target features
-        if not isinstance(t_samples, NestedTensor):
-            t_samples = nested_tensor_from_tensor_list(t_samples)
-        t_features = self.backbone(t_samples)['0']
-        t_src, t_mask = t_features.decompose()
-        t_src = self.input_proj(t_src)
-        assert t_mask is not None
-        # flatten vectors
-        t_src = t_src.flatten(2)
-        t_mask = t_mask.flatten(1)
+        t_src, t_mask = self._encode(t_samples)
 
         # location features
         loc_src = self.loc_proj(loc_feats).unsqueeze(-1)
-        loc_masks = torch.zeros(
-            (loc_feats.shape[0], 1)).bool().to(t_mask.device)
+        loc_masks = self.loc_mask_const.expand(t_mask.size(0), loc_src.size(2))
 
         # concatenate target and location to target vector
-        src = torch.concat([t_src, loc_src], 2)
-        mask = torch.concat([t_mask, loc_masks], 1)
+        src, mask = concat_to_buffer(t_src, t_mask, loc_src, loc_masks)
+
+        return src, mask, None, None
+
+    def decode(self, src_t, mask_t, src_c, mask_c, target_exp, target_exp_mask, return_attention=False):
 
         hs, att = self.transformer(
-            src_t=src, mask_t=mask, 
-            src_c=None, mask_c=None, 
+            src_t=src_t, mask_t=mask_t, 
+            src_c=src_c, mask_c=mask_c, 
             tgt=target_exp, tgt_mask=target_exp_mask)
         out = self.mlp(hs.permute(1, 0, 2))
 
@@ -95,7 +138,7 @@ class CaptionLoc(nn.Module):
         return out
     
 
-class CaptionGlobalLoc(nn.Module):
+class CaptionGlobalLoc(_CaptionBase):
 
     def __init__(self, backbone, transformer, positional_encoding, hidden_dim,
                  vocab_size):
@@ -107,48 +150,38 @@ class CaptionGlobalLoc(nn.Module):
                                     kernel_size=1)
         self.loc_proj = nn.Linear(1, hidden_dim)
         self.transformer = transformer
-        self.mlp = MLP(hidden_dim, 512, vocab_size, 3)
+        self.mlp = MLP(hidden_dim, 512, vocab_size)
+        # location features are never masked out
+        self.register_buffer('loc_mask_const', torch.zeros(1, 1, dtype=torch.bool), persistent=False)
 
     def forward(self, t_samples, g_samples, loc_feats, target_exp, target_exp_mask, return_attention=False):
+        return self.decode(*self.encode(t_samples, g_samples, loc_feats), target_exp, target_exp_mask,
+                           return_attention=return_attention)
+
+    def encode(self, t_samples, g_samples, loc_feats):
 
         # target features
-        if not isinstance(t_samples, NestedTensor):
-            t_samples = nested_tensor_from_tensor_list(t_samples)
-        t_features = self.backbone(t_samples)['0']
-        t_src, t_mask = t_features.decompose()
-        t_src = self.input_proj(t_src)
-        assert t_mask is not None
-        # flatten vectors
-        t_src = t_src.flatten(2)  # [b, hidden_dim, len]
-        t_mask = t_mask.flatten(1)  # [b, len]
+        t_src, t_mask = self._encode(t_samples)  # [b, hidden_dim, len], [b, len]
 
         # location features
         loc_src = loc_feats.unsqueeze(2) # [b, n_feats] -> [b, n_feats, 1]
         loc_src = self.loc_proj(loc_src)  # [b, n_feats, hidden_dim]
         loc_src = loc_src.permute(0,2,1)  # [b, hidden_dim, n_feats]
-        loc_masks = torch.zeros(
-            (loc_src.shape[0], loc_src.shape[2])).bool().to(t_mask.device)
+        loc_masks = self.loc_mask_const.expand(t_mask.size(0), loc_src.size(2))
 
         # concatenate target and location to target vector
-        target_src = torch.concat([t_src, loc_src], 2)
-        target_mask = torch.concat([t_mask, loc_masks], 1)
-
-        # global features
-        if not isinstance(g_samples, NestedTensor):
-            g_samples = nested_tensor_from_tensor_list(g_samples)
-        g_features = self.backbone(g_samples)['0']
-        g_src, g_mask = g_features.decompose()
-        g_src = self.input_proj(g_src)
-        assert g_mask is not None
-        # ensure there are unmasked context values
-        g_mask = ensure_unmasked_values(g_mask)
-        # flatten vectors
-        g_src = g_src.flatten(2)  # [b, hidden_dim, len]
-        g_mask = g_mask.flatten(1)  # [b, len]
+        target_src, target_mask = concat_to_buffer(t_src, t_mask, loc_src, loc_masks)
+
+        # global features (ensure there are unmasked context values)
+        g_src, g_mask = self._encode(g_samples, ensure_unmasked=True)  # [b, hidden_dim, len], [b, len]
+
+        return target_src, target_mask, g_src, g_mask
+
+    def decode(self, src_t, mask_t, src_c, mask_c, target_exp, target_exp_mask, return_attention=False):
 
         hs, att = self.transformer(
-            src_t=target_src, mask_t=target_mask, 
-            src_c=g_src, mask_c=g_mask, 
+            src_t=src_t, mask_t=mask_t, 
+            src_c=src_c, mask_c=mask_c, 
             tgt=target_exp, tgt_mask=target_exp_mask)
         out = self.mlp(hs.permute(1, 0, 2))
         
@@ -158,25 +191,58 @@ class CaptionGlobalLoc(nn.Module):
         return out
     
 
+def concat_to_buffer(t_src, t_mask, loc_src, loc_mask):
+    """
+    concatenate image and location features (and masks) along the sequence axis
+    by writing them into preallocated output tensors
+    """
+    b, hidden_dim, l_img = t_src.shape
+    l_loc = loc_src.size(2)
+
+    src = t_src.new_empty((b, hidden_dim, l_img + l_loc))
+    src[..., :l_img] = t_src
+    src[..., l_img:] = loc_src
+
+    mask = t_mask.new_empty((b, l_img + l_loc))
+    mask[:, :l_img] = t_mask
+    mask[:, l_img:] = loc_mask
+
+    return src, mask
+
+
 class MLP(nn.Module):
-    """ Very simple multi-layer perceptron (also called FFN)"""
+    """ Very simple 3-layer perceptron (also called FFN)"""
 
-    def __init__(self, input_dim, hidden_dim, output_dim, num_layers):
+    def __init__(self, input_dim, hidden_dim, output_dim):
         super().__init__()
-        self.num_layers = num_layers
-        h = [hidden_dim] * (num_layers - 1)
-        self.layers = nn.ModuleList(
-            nn.Linear(n, k) for n, k in zip([input_dim] + h, h + [output_dim]))
+        self.l1 = nn.Linear(input_dim, hidden_dim)
+        self.l2 = nn.Linear(hidden_dim, hidden_dim)
+        self.l3 = nn.Linear(hidden_dim, output_dim)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # map checkpoints with ModuleList layout (layers.0, layers.1, layers.2)
+        for i, name in enumerate(['l1', 'l2', 'l3']):
+            for param in ['weight', 'bias']:
+                old_key = f'{prefix}layers.{i}.{param}'
+                if old_key in state_dict:
+                    state_dict[f'{prefix}{name}.{param}'] = state_dict.pop(old_key)
+
+        super(MLP, self)._load_from_state_dict(
+            state_dict, prefix, local_metadata, strict,
+            missing_keys, unexpected_keys, error_msgs)
 
     def forward(self, x):
-        for i, layer in enumerate(self.layers):
-            x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
-        return x
+        # linear outputs are not needed for backward, relu can be applied in place
+        x = F.relu_(self.l1(x))
+        x = F.relu_(self.l2(x))
+        return self.l3(x)
 
 
-def build_model(config):
+def build_model(config, pretrained_backbone=True):
     
-    backbone = build_backbone(config)
+    # pretrained backbone weights can be skipped if a full checkpoint is loaded afterwards
+    backbone = build_backbone(config, pretrained=pretrained_backbone)
     
     transformer = build_concat_transformer(config)
 
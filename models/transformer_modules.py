@@ -45,6 +45,50 @@ class SelfAttResidual(AttResidualBase):
         
         return res_out, att_weights
 
+    def forward_step(
+            self,
+            qkv,
+            qkv_pos,
+            cache_k, cache_v,
+            step, attn_mask
+        ):
+        """
+        self attention for the position `step` only;
+        projected keys and values of previous positions are read from
+        cache_k / cache_v ([b, nhead, max_len, head_dim], updated in place)
+        """
+
+        mha = self.sublayer
+        embed_dim, num_heads = mha.embed_dim, mha.num_heads
+        w_q, w_k, w_v = mha.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = mha.in_proj_bias.chunk(3) if mha.in_proj_bias is not None else (None, None, None)
+
+        def split_heads(x):
+            # [1, b, d_model] -> [b, nhead, 1, head_dim]
+            return x.view(x.size(1), num_heads, embed_dim // num_heads).unsqueeze(2)
+
+        # pre norm
+        norm_qkv = self.norm(qkv)
+
+        # positional encoding, project the new position only
+        query = with_pos_embed(norm_qkv, qkv_pos)
+        q = split_heads(F.linear(query, w_q, b_q))
+        cache_k.index_copy_(2, step, split_heads(F.linear(query, w_k, b_k)).to(cache_k.dtype))
+        cache_v.index_copy_(2, step, split_heads(F.linear(norm_qkv, w_v, b_v)).to(cache_v.dtype))
+
+        # self attention over the cache (attn_mask is True for future positions)
+        att_out = F.scaled_dot_product_attention(
+            q, cache_k, cache_v, attn_mask=~attn_mask,
+            dropout_p=mha.dropout if self.training else 0.0
+        )
+        att_out = att_out.squeeze(2).unsqueeze(0).flatten(2)  # [1, b, d_model]
+        att_out = F.linear(att_out, mha.out_proj.weight, mha.out_proj.bias)
+
+        # residual + dropout
+        res_out = qkv + self.dropout(att_out)
+
+        return res_out
+
 
 class CrossAttResidual(AttResidualBase):
     def forward(
@@ -110,14 +154,15 @@ class DecoderEmbeddings(nn.Module):
             config.hidden_dim, eps=config.layer_norm_eps)
         self.dropout = nn.Dropout(config.dropout)
 
-    def forward(self, x):
+    def forward(self, x, position_ids=None):
         input_shape = x.size()
         seq_length = input_shape[1]
         device = x.device
 
-        position_ids = torch.arange(
-            seq_length, dtype=torch.long, device=device)
-        position_ids = position_ids.unsqueeze(0).expand(input_shape)
+        if position_ids is None:
+            position_ids = torch.arange(
+                seq_length, dtype=torch.long, device=device)
+            position_ids = position_ids.unsqueeze(0).expand(input_shape)
 
         input_embeds = self.word_embeddings(x)
         position_embeds = self.position_embeddings(position_ids)
@@ -1,5 +1,5 @@
 import copy
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -47,11 +47,11 @@ def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
 
 
-def generate_square_subsequent_mask(sz):
+def generate_square_subsequent_mask(sz, device=None):
     r"""Generate a square mask for the sequence. The masked positions are filled with float('-inf').
         Unmasked positions are filled with float(0.0).
     """
-    mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
+    mask = (torch.triu(torch.ones(sz, sz, device=device)) == 1).transpose(0, 1)
     mask = mask.float().masked_fill(mask == 0, float(
         '-inf')).masked_fill(mask == 1, float(0.0))
     return mask
@@ -109,19 +109,40 @@ def nested_tensor_from_tensor_list(tensor_list: List[Tensor]):
     return NestedTensor(tensor, mask)
 
 
+# all-False masks for batches of equally sized images
+# keyed by (batch size, height, width, device)
+_uniform_mask_cache: Dict[Tuple[int, int, int, torch.device], Tensor] = {}
+
+
+def as_nested_tensor(samples):
+    """
+    wrap model inputs as NestedTensor;
+    batched images of uniform size are paired with a cached mask instead of being re-padded
+    """
+    if isinstance(samples, NestedTensor):
+        return samples
+    if isinstance(samples, Tensor) and samples.ndim == 4:
+        b, _, h, w = samples.shape
+        key = (b, h, w, samples.device)
+        if key not in _uniform_mask_cache:
+            _uniform_mask_cache[key] = torch.zeros((b, h, w), dtype=torch.bool, device=samples.device)
+        return NestedTensor(samples, _uniform_mask_cache[key])
+    return nested_tensor_from_tensor_list(samples)
+
+
 class NestedTensor(object):
     def __init__(self, tensors, mask: Optional[Tensor]):
         self.tensors = tensors
         self.mask = mask
         self.shape = self.mask.shape
 
-    def to(self, device):
-        # type: (Device) -> NestedTensor # noqa
-        cast_tensor = self.tensors.to(device)
+    def to(self, device, non_blocking=False):
+        # type: (Device, bool) -> NestedTensor # noqa
+        cast_tensor = self.tensors.to(device, non_blocking=non_blocking)
         mask = self.mask
         if mask is not None:
             assert mask is not None
-            cast_mask = mask.to(device)
+            cast_mask = mask.to(device, non_blocking=non_blocking)
         else:
             cast_mask = None
         return NestedTensor(cast_tensor, cast_mask)
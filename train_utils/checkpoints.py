@@ -1,24 +1,80 @@
 import torch
+import numpy as np
 import os
 
-def save_ckp(epoch, model, optimizer, lr_scheduler, train_loss, val_loss, cider_score, path):
-    """save training checkpoint"""
+def build_ckp(epoch, model, optimizer, lr_scheduler, train_loss, val_loss, cider_score):
+    """collect training state for checkpointing"""
 
-    torch.save({
+    return {
         'epoch': epoch,
         'model_state_dict': model.state_dict(),
         'optimizer_state_dict': optimizer.state_dict(),
         'lr_scheduler_state_dict': lr_scheduler.state_dict(),
-        'train_loss': train_loss,
-        'val_loss': val_loss,
-        'cider_score': cider_score
-    }, path)
+        # plain floats keep checkpoints loadable with weights_only=True
+        'train_loss': float(train_loss),
+        'val_loss': float(val_loss),
+        'cider_score': float(cider_score)
+    }
+
+
+def save_ckp(epoch, model, optimizer, lr_scheduler, train_loss, val_loss, cider_score, path):
+    """save training checkpoint"""
+
+    torch.save(build_ckp(
+        epoch, model, optimizer, lr_scheduler, train_loss, val_loss, cider_score
+    ), path)
+
+
+def copy_to_cpu(obj):
+    """recursively copy tensors in (nested) state dicts to host memory"""
+
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: copy_to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(v) for v in obj)
+    return obj
+
+
+def save_ckp_async(executor, epoch, model, optimizer, lr_scheduler, train_loss, val_loss, cider_score, path):
+    """
+    snapshot training state to host memory and save checkpoint in the background
+    (returns a future for the write)
+    """
+
+    checkpoint = copy_to_cpu(build_ckp(
+        epoch, model, optimizer, lr_scheduler, train_loss, val_loss, cider_score
+    ))
+
+    return executor.submit(torch.save, checkpoint, path)
+
+
+def numpy_scalar_globals():
+    """globals required to unpickle numpy float scalars (stored as metrics by older checkpoints)"""
+
+    multiarray = np._core.multiarray if hasattr(np, '_core') else np.core.multiarray
+    # dtype class (np.dtypes.Float64DType for numpy >= 1.25, np.dtype before)
+    float64_dtype = type(np.dtype(np.float64))
+    return list({multiarray.scalar, np.dtype, float64_dtype})
+
+
+def read_ckp(path, map_location='cpu'):
+    """read checkpoint file (memory-mapped, restricted to tensors, primitive types and numpy scalars)"""
+
+    if hasattr(torch.serialization, 'safe_globals'):
+        with torch.serialization.safe_globals(numpy_scalar_globals()):
+            return torch.load(path, map_location=map_location, mmap=True, weights_only=True)
+
+    # torch < 2.5: no context manager, allowlist the globals for the process instead
+    torch.serialization.add_safe_globals(numpy_scalar_globals())
+    return torch.load(path, map_location=map_location, mmap=True, weights_only=True)
 
 
 def load_ckp(model, optimizer, lr_scheduler, path):
     """load training checkpoint"""
 
-    checkpoint = torch.load(path, map_location='cpu')
+    checkpoint = read_ckp(path)
 
     model.load_state_dict(checkpoint['model_state_dict'])
     optimizer.load_state_dict(checkpoint['optimizer_state_dict'])